@@ -1,7 +1,14 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 import contextlib
+import functools
+import ipaddress
+import logging
 import socket
+import threading
 import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
 
 # save original socket method for restoration
 # These are global so that re-calling the turn_off_internet function doesn't
@@ -17,90 +24,339 @@ ASTROPY_HOSTS = (['data.astropy.org', 'astropy.stsci.edu', 'www.astropy.org'] +
 
 INTERNET_OFF = False
 
+# Guards INTERNET_OFF and the patching of the socket module, so that
+# concurrent calls cannot save an already wrapped function as the original.
+# _DEPTH counts the outstanding turn_off_internet calls, so that nested
+# disabling (e.g. via no_internet) is only undone by the outermost call.
+_STATE_LOCK = threading.Lock()
+_DEPTH = 0
+
+# Loopback addresses are always allowed and are checked before any name
+# resolution is attempted
+_LOOPBACK = frozenset({'localhost', '127.0.0.1', '::1', '::ffff:127.0.0.1'})
+_LOOPBACK_NETS = (ipaddress.ip_network('127.0.0.0/8'),
+                  ipaddress.ip_network('::1/128'),
+                  ipaddress.ip_network('::ffff:127.0.0.0/104'))
+
+# Local hosts accepted alongside the resolved allow-list
+# ::1 is apparently another valid name for localhost?
+# it is returned by getaddrinfo when that function is given localhost
+_LOCAL_HOSTS = frozenset({'localhost', '127.0.0.1', '::1'})
+
+# Socket families whose operations are checked; others such as AF_UNIX are
+# always allowed
+_INET_FAMILIES = frozenset({socket.AF_INET, socket.AF_INET6})
+
+# Names of the local machine; looked up lazily (getfqdn may do a reverse DNS
+# lookup) and then cached for the lifetime of the process
+_SELF_NAMES = None
+
 # urllib2 uses a global variable to cache its default "opener" for opening
 # connections for various protocols; we store it off here so we can restore to
-# the default after re-enabling internet use
+# the default after re-enabling internet use.  Both openers are only built
+# once, the first time internet access is disabled
 _orig_opener = None
+_no_proxy_opener = None
+
 
+def _is_ip_literal(host):
+    """
+    If ``host`` is already an IPv4 or IPv6 address rather than a name that
+    needs resolving, return it parsed by `ipaddress.ip_address`; otherwise
+    return `None`.
+    """
+    # Host names almost never end in a digit, so skip raising and catching a
+    # ValueError for them
+    if not isinstance(host, str) or not (':' in host or host[-1:].isdigit()):
+        return None
+
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        return None
 
+
+@functools.lru_cache(maxsize=128)
 def _resolve_host_ips(hostname, port=80):
     """
     Obtain all the IPs, including aliases, in a way that supports
     IPv4/v6 dual stack.
+
+    Results are cached for the lifetime of the process, so the returned set
+    is a `frozenset` that is safe to share between callers.  Failed lookups
+    are cached too, so that without a network each host only waits on the
+    resolver once.
     """
+    # Include the canonical form that getaddrinfo would have returned, so
+    # that e.g. '2001:DB8:0:0::1' still matches '2001:db8::1'
+    ip = _is_ip_literal(hostname)
+    if ip is not None:
+        return frozenset({hostname, str(ip)})
+
     try:
         ips = {s[-1][0] for s in socket.getaddrinfo(hostname, port)}
-    except socket.gaierror:
+    except socket.gaierror as exc:
+        log.info("Could not resolve %s, only its name will be matched: %s",
+                 hostname, exc)
         ips = set()
 
     ips.add(hostname)
-    return ips
+    return frozenset(ips)
 
 
-# ::1 is apparently another valid name for localhost?
-# it is returned by getaddrinfo when that function is given localhost
+def _self_names():
+    """
+    Return the hostname and fully qualified domain name of the local machine.
+    """
+    global _SELF_NAMES
+
+    if _SELF_NAMES is None:
+        _SELF_NAMES = frozenset({socket.gethostname(), socket.getfqdn()})
+    return _SELF_NAMES
+
+
+def _allowed_host_names(allow_astropy_data=False, allow_github_data=False):
+    """
+    Return the names of the remote hosts that may be accessed without the
+    ``remote_data`` marker.
+
+    Allowing Astropy data also automatically allow GitHub data.
+    """
+    if allow_astropy_data:
+        return frozenset(ASTROPY_HOSTS)
+    elif allow_github_data:
+        return frozenset(GITHUB_HOSTS)
+    else:
+        return frozenset()
+
+
+def _resolve_allowed_hosts(allow_astropy_data=False, allow_github_data=False):
+    """
+    Resolve the remote hosts that may be accessed without the
+    ``remote_data`` marker into a single `frozenset` of names and IPs.
+    """
+    hosts = _allowed_host_names(allow_astropy_data=allow_astropy_data,
+                                allow_github_data=allow_github_data)
+    if not hosts:
+        return frozenset()
+
+    # Look the hosts up concurrently, so that a blocked host only waits for
+    # the slowest lookup rather than all of them; the workers exit as soon
+    # as the lookups are done
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        ip_sets = list(executor.map(_resolve_host_ips, hosts))
+
+    return frozenset().union(*ip_sets)
+
+
+@functools.lru_cache(maxsize=None)
+def _valid_hosts(allow_astropy_data, allow_github_data):
+    """
+    Return the `frozenset` of local and allowed remote names and IPs that the
+    wrappers installed by `turn_off_internet` accept.  There are only a
+    handful of possible combinations, so each is built once and reused by
+    later calls to `turn_off_internet`.
+    """
+    return _LOCAL_HOSTS | _resolve_allowed_hosts(
+        allow_astropy_data=allow_astropy_data,
+        allow_github_data=allow_github_data)
+
+
+def _prefetch_valid_hosts(allow_astropy_data, allow_github_data):
+    """
+    Start building the set returned by `_valid_hosts` in a background thread,
+    returning a `~concurrent.futures.Future` for it.  If there are no remote
+    hosts to resolve the set is returned directly instead.
+    """
+    if not _allowed_host_names(allow_astropy_data=allow_astropy_data,
+                               allow_github_data=allow_github_data):
+        return _LOCAL_HOSTS
+
+    future = Future()
+
+    def resolve():
+        try:
+            future.set_result(_valid_hosts(allow_astropy_data,
+                                           allow_github_data))
+        except BaseException as exc:
+            future.set_exception(exc)
+
+    # The thread exits as soon as the lookups are done; it is a daemon so
+    # that a slow resolver cannot hold up interpreter shutdown
+    thread = threading.Thread(target=resolve, name='remotedata-prefetch',
+                              daemon=True)
+    thread.start()
+
+    return future
+
+
+def _make_host_check(valid_hosts, allowed_names, local_names):
+    """
+    Return a function that takes the host of an address about to be used by a
+    socket operation and returns the host to actually use, or raises an
+    `OSError` if that host is not local or in the allow-list.
+
+    ``valid_hosts`` may be a `~concurrent.futures.Future`, in which case it is
+    only waited for once a host has to be checked against resolved IPs.
+    """
+
+    allowed_suffixes = tuple(sorted('.' + name for name in allowed_names))
+
+    # Bind the globals used on every call to closure variables so they do not
+    # need to be looked up through the module namespace each time
+    loopback = _LOOPBACK
+    loopback_nets = _LOOPBACK_NETS
+    is_ip_literal = _is_ip_literal
+    resolve_host_ips = _resolve_host_ips
+
+    def check_host(host):
+        nonlocal valid_hosts
+
+        # Cheap check for the most common case before any DNS lookups
+        if host in loopback:
+            return host
+
+        ip = is_ip_literal(host)
+        if ip is not None:
+            # Any other address in the loopback networks
+            if any(ip in net for net in loopback_nets):
+                return host
+
+            # Other addresses need no lookup, only their canonical form
+            host_ips = frozenset({host, str(ip)})
+        else:
+            # Allowed remote hosts matched by name need no resolution either
+            if host in allowed_names or (isinstance(host, str) and
+                                         host.endswith(allowed_suffixes)):
+                return host
+
+            if host in local_names:
+                return 'localhost'
+
+            host_ips = resolve_host_ips(host)
+
+        if isinstance(valid_hosts, Future):
+            valid_hosts = valid_hosts.result()
+
+        # Any overlap is acceptable; iterate over the smaller of the two sets
+        if len(host_ips) > len(valid_hosts):
+            if not valid_hosts.isdisjoint(host_ips):
+                return host
+        elif not host_ips.isdisjoint(valid_hosts):
+            return host
+
+        raise OSError("An attempt was made to connect to the internet "
+                      "by a test that was not marked `remote_data`. The "
+                      "requested host was: {}".format(host))
+
+    return check_host
+
+
+def _make_socket_method_wrapper(original_function, valid_hosts,
+                                allowed_names, local_names):
+    """
+    Wraps ``original_function``, a `socket.socket` method such as ``bind`` or
+    ``connect`` that takes the address as its first argument, to raise an
+    `OSError` for any operations on non-local AF_INET sockets.
+    """
+
+    check_host = _make_host_check(valid_hosts, allowed_names, local_names)
+    inet_families = _INET_FAMILIES
+
+    def new_function(sock, address, *args, **kwargs):
+        if sock.family not in inet_families:
+            # Should be fine in all but some very obscure cases
+            # More to the point, we don't want to affect AF_UNIX
+            # sockets.
+            return original_function(sock, address, *args, **kwargs)
+
+        host = address[0]
+        new_host = check_host(host)
+        if new_host is not host:
+            address = (new_host,) + address[1:]
+        return original_function(sock, address, *args, **kwargs)
+
+    return new_function
+
+
+def _make_create_connection_wrapper(original_function, valid_hosts,
+                                    allowed_names, local_names):
+    """
+    Wraps ``original_function``, assumed to be `socket.create_connection`, to
+    raise an `OSError` for any connections to non-local hosts.
+    """
+
+    check_host = _make_host_check(valid_hosts, allowed_names, local_names)
+
+    def new_function(address, *args, **kwargs):
+        # socket.create_connection should be passed a 2-tuple, but we'll
+        # check just in case
+        if not (isinstance(address, tuple) and len(address) == 2):
+            return original_function(address, *args, **kwargs)
+
+        new_host = check_host(address[0])
+        if new_host is not address[0]:
+            address = (new_host, address[1])
+        return original_function(address, *args, **kwargs)
+
+    return new_function
+
 
 def check_internet_off(original_function, allow_astropy_data=False,
                        allow_github_data=False):
     """
     Wraps ``original_function``, which in most cases is assumed
-    to be a `socket.socket` method, to raise an `IOError` for any operations
+    to be a `socket.socket` method, to raise an `OSError` for any operations
     on non-local AF_INET sockets.
 
     Allowing Astropy data also automatically allow GitHub data.
+
+    This is no longer used by `turn_off_internet`, which installs wrappers
+    specialized for each function it replaces, and is kept only for backward
+    compatibility.  The returned function works out on each call whether it
+    was given a socket or an address, and uses the same cached allow-list as
+    `turn_off_internet`.
     """
 
+    valid_hosts = _valid_hosts(allow_astropy_data, allow_github_data)
+    allowed_names = _allowed_host_names(
+        allow_astropy_data=allow_astropy_data,
+        allow_github_data=allow_github_data)
+    local_names = _self_names()
+
+    socket_method = _make_socket_method_wrapper(
+        original_function, valid_hosts, allowed_names, local_names)
+    create_connection = _make_create_connection_wrapper(
+        original_function, valid_hosts, allowed_names, local_names)
+
     def new_function(*args, **kwargs):
         if isinstance(args[0], socket.socket):
-            if not args[0].family in (socket.AF_INET, socket.AF_INET6):
-                # Should be fine in all but some very obscure cases
-                # More to the point, we don't want to affect AF_UNIX
-                # sockets.
-                return original_function(*args, **kwargs)
-            host = args[1][0]
-            addr_arg = 1
-            valid_hosts = {'localhost', '127.0.0.1', '::1'}
-        else:
-            # The only other function this is used to wrap currently is
-            # socket.create_connection, which should be passed a 2-tuple, but
-            # we'll check just in case
-            if not (isinstance(args[0], tuple) and len(args[0]) == 2):
-                return original_function(*args, **kwargs)
-
-            host = args[0][0]
-            addr_arg = 0
-            valid_hosts = {'localhost', '127.0.0.1'}
-
-        # Astropy + GitHub data
-        if allow_astropy_data:
-            for valid_host in ASTROPY_HOSTS:
-                valid_hosts = valid_hosts.union(_resolve_host_ips(valid_host))
-
-        # Only GitHub data
-        elif allow_github_data:
-            for valid_host in GITHUB_HOSTS:
-                valid_hosts = valid_hosts.union(_resolve_host_ips(valid_host))
-
-        hostname = socket.gethostname()
-        fqdn = socket.getfqdn()
-
-        if host in (hostname, fqdn):
-            host = 'localhost'
-            host_ips = {host}
-            new_addr = (host, args[addr_arg][1])
-            args = args[:addr_arg] + (new_addr,) + args[addr_arg + 1:]
+            return socket_method(*args, **kwargs)
         else:
-            host_ips = _resolve_host_ips(host)
+            return create_connection(*args, **kwargs)
 
-        if len(host_ips & valid_hosts) > 0:  # Any overlap is acceptable
-            return original_function(*args, **kwargs)
-        else:
-            raise OSError("An attempt was made to connect to the internet "
-                          "by a test that was not marked `remote_data`. The "
-                          "requested host was: {}".format(host))
     return new_function
 
 
+def _setup_urllib_no_proxy():
+    """
+    Update urllib to force it not to use any proxies, saving the default
+    opener the first time so that it can be restored by `turn_on_internet`.
+    """
+
+    global _orig_opener
+    global _no_proxy_opener
+
+    if _orig_opener is None:
+        _orig_opener = urllib.request.build_opener()
+        # Must use {} here (the default of None will kick off an automatic
+        # search for proxies)
+        no_proxy_handler = urllib.request.ProxyHandler({})
+        _no_proxy_opener = urllib.request.build_opener(no_proxy_handler)
+
+    urllib.request.install_opener(_no_proxy_opener)
+
+
 def turn_off_internet(verbose=False, allow_astropy_data=False,
                       allow_github_data=False):
     """
@@ -111,75 +367,91 @@ def turn_off_internet(verbose=False, allow_astropy_data=False,
     """
 
     global INTERNET_OFF
-    global _orig_opener
+    global _DEPTH
 
-    if INTERNET_OFF:
-        return
+    with _STATE_LOCK:
+        _DEPTH += 1
+        if _DEPTH > 1:
+            return
 
-    INTERNET_OFF = True
+        INTERNET_OFF = True
 
-    __tracebackhide__ = True
-    if verbose:
-        print("Internet access disabled")
+        __tracebackhide__ = True
+        if verbose:
+            print("Internet access disabled")
 
-    # Update urllib2 to force it not to use any proxies
-    # Must use {} here (the default of None will kick off an automatic search
-    # for proxies)
-    _orig_opener = urllib.request.build_opener()
-    no_proxy_handler = urllib.request.ProxyHandler({})
-    opener = urllib.request.build_opener(no_proxy_handler)
-    urllib.request.install_opener(opener)
+        _setup_urllib_no_proxy()
 
-    socket.create_connection = check_internet_off(
-        socket_create_connection, allow_astropy_data=allow_astropy_data,
-        allow_github_data=allow_github_data)
-    socket.socket.bind = check_internet_off(
-        socket_bind, allow_astropy_data=allow_astropy_data,
-        allow_github_data=allow_github_data)
-    socket.socket.connect = check_internet_off(
-        socket_connect, allow_astropy_data=allow_astropy_data,
-        allow_github_data=allow_github_data)
+        # Look up the allow-list and the local machine's names once, rather
+        # than on every wrapped socket operation
+        allowed_names = _allowed_host_names(
+            allow_astropy_data=allow_astropy_data,
+            allow_github_data=allow_github_data)
+        # The allow-list is resolved in the background; the wrappers only
+        # wait for it when a host is not matched by name
+        valid_hosts = _prefetch_valid_hosts(allow_astropy_data,
+                                            allow_github_data)
+        local_names = _self_names()
+
+        socket.create_connection = _make_create_connection_wrapper(
+            socket_create_connection, valid_hosts, allowed_names,
+            local_names)
+        socket.socket.bind = _make_socket_method_wrapper(
+            socket_bind, valid_hosts, allowed_names, local_names)
+        socket.socket.connect = _make_socket_method_wrapper(
+            socket_connect, valid_hosts, allowed_names, local_names)
 
-    return socket
+        return socket
 
 
 def turn_on_internet(verbose=False):
     """
-    Restore internet access.  Not used, but kept in case it is needed.
+    Undo one call to `turn_off_internet`.  Calls nest, so internet access is
+    only restored by the call matching the outermost `turn_off_internet`;
+    extra calls when internet access is already enabled do nothing.
     """
 
     global INTERNET_OFF
-    global _orig_opener
+    global _DEPTH
+
+    with _STATE_LOCK:
+        if _DEPTH == 0:
+            return
 
-    if not INTERNET_OFF:
-        return
+        _DEPTH -= 1
+        if _DEPTH > 0:
+            return
 
-    INTERNET_OFF = False
+        INTERNET_OFF = False
 
-    if verbose:
-        print("Internet access enabled")
+        if verbose:
+            print("Internet access enabled")
 
-    urllib.request.install_opener(_orig_opener)
+        urllib.request.install_opener(_orig_opener)
 
-    socket.create_connection = socket_create_connection
-    socket.socket.bind = socket_bind
-    socket.socket.connect = socket_connect
-    return socket
+        socket.create_connection = socket_create_connection
+        socket.socket.bind = socket_bind
+        socket.socket.connect = socket_connect
+        return socket
 
 
-@contextlib.contextmanager
-def no_internet(verbose=False):
+class _NoInternet(contextlib.ContextDecorator):
     """Context manager to temporarily disable internet access (if not already
     disabled).  If it was already disabled before entering the context manager
     (i.e. `turn_off_internet` was called previously) then this is a no-op and
-    leaves internet access disabled until a manual call to `turn_on_internet`.
+    leaves internet access disabled until a matching call to
+    `turn_on_internet`.
     """
 
-    already_disabled = INTERNET_OFF
+    def __init__(self, verbose=False):
+        self._verbose = verbose
 
-    turn_off_internet(verbose=verbose)
-    try:
-        yield
-    finally:
-        if not already_disabled:
-            turn_on_internet(verbose=verbose)
+    def __enter__(self):
+        turn_off_internet(verbose=self._verbose)
+        return self
+
+    def __exit__(self, *exc):
+        turn_on_internet(verbose=self._verbose)
+
+
+no_internet = _NoInternet
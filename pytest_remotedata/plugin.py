@@ -52,8 +52,10 @@ def pytest_unconfigure():
     """
     Cleanup post-testing
     """
-    # restore internet connectivity (only lost if remote_data=False and
-    # turn_off_internet previously called)
+    # undo the turn_off_internet call made in pytest_configure (only made if
+    # remote_data_strict is set and remote_data is not 'any').  Calls nest, so
+    # connectivity stays disabled if a test left an unmatched
+    # turn_off_internet call behind.
     # this is harmless / does nothing if socket connections were never disabled
     turn_on_internet()
 
@@ -1,11 +1,18 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+import socket
+import threading
 import time
+import urllib.request
+from concurrent.futures import Future
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from threading import Thread
 from urllib.request import urlopen
 
 import pytest
-from pytest_remotedata.disable_internet import no_internet
+from pytest_remotedata import disable_internet
+from pytest_remotedata.disable_internet import (
+    _make_create_connection_wrapper, _make_host_check, _resolve_host_ips,
+    no_internet)
 
 
 def test_outgoing_fails():
@@ -14,44 +21,38 @@ def test_outgoing_fails():
             urlopen('http://www.python.org')
 
 
-class StoppableHTTPServer(HTTPServer):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.stop = False
-
-    def handle_request(self):
-        self.stop = True
-        super().handle_request()
-
-    def serve_forever(self):
-        """
-        Serve until stop set, which will happen if any request is handled
-        """
-        while not self.stop:
-            self.handle_request()
-
-
-@pytest.mark.parametrize(('localhost'), ('localhost', '127.0.0.1'))
-def test_localconnect_succeeds(localhost):
+@pytest.fixture(scope='module')
+def local_http_server():
     """
-    Ensure that connections to localhost are allowed, since these are genuinely
-    not remotedata.
+    Serve HTTP on an open localhost port for the duration of the module,
+    yielding the port number.
     """
 
     # port "0" means find open port
     # see http://stackoverflow.com/questions/1365265/on-localhost-how-to-pick-a-free-port-number
-    httpd = StoppableHTTPServer(('localhost', 0), SimpleHTTPRequestHandler)
-
-    port = httpd.socket.getsockname()[1]
+    httpd = HTTPServer(('localhost', 0), SimpleHTTPRequestHandler)
 
-    server = Thread(target=httpd.serve_forever)
+    # The server is already listening, so there is no need to wait for the
+    # thread to start before connecting
+    server = Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.01})
     server.daemon = True
-
     server.start()
-    time.sleep(0.1)
 
-    urlopen(f'http://{localhost:s}:{port:d}').close()
+    yield httpd.socket.getsockname()[1]
+
+    httpd.shutdown()
     httpd.server_close()
+    server.join()
+
+
+@pytest.mark.parametrize(('localhost'), ('localhost', '127.0.0.1'))
+def test_localconnect_succeeds(localhost, local_http_server):
+    """
+    Ensure that connections to localhost are allowed, since these are genuinely
+    not remotedata.
+    """
+
+    urlopen(f'http://{localhost:s}:{local_http_server:d}').close()
 
 
 # Used for the below test--inline functions aren't pickleable
@@ -60,8 +61,25 @@ def _square(x):
     return x ** 2
 
 
+@pytest.fixture(scope='session')
+def forkserver_pool():
+    """
+    A single-worker forkserver pool shared across the session, since starting
+    the forkserver dominates the cost of using it.
+    """
+
+    import multiprocessing
+    ctx = multiprocessing.get_context('forkserver')
+    pool = ctx.Pool(1)
+
+    yield pool
+
+    pool.close()
+    pool.join()
+
+
 @pytest.mark.skipif('sys.platform == "win32" or sys.platform.startswith("gnu0")')
-def test_multiprocessing_forkserver():
+def test_multiprocessing_forkserver(forkserver_pool):
     """
     Test that using multiprocessing with forkserver works.  Perhaps
     a simpler more direct test would be to just open some local
@@ -70,10 +88,211 @@ def test_multiprocessing_forkserver():
     Regression test for https://github.com/astropy/astropy/pull/3713
     """
 
-    import multiprocessing
-    ctx = multiprocessing.get_context('forkserver')
-    pool = ctx.Pool(1)
-    result = pool.map(_square, [1, 2, 3, 4, 5])
-    pool.close()
-    pool.join()
+    result = forkserver_pool.map(_square, [1, 2, 3, 4, 5], chunksize=5)
     assert result == [1, 4, 9, 16, 25]
+
+
+def _connect(address, *args, **kwargs):
+    # Stand-in for socket.create_connection that reports what it was given
+    return address, args, kwargs
+
+
+def _wrap_connect(allowed_names=frozenset(), local_names=frozenset()):
+    # Wrap _connect with an allow-list that does not depend on DNS
+    return _make_create_connection_wrapper(
+        _connect, disable_internet._LOCAL_HOSTS, allowed_names, local_names)
+
+
+def test_resolve_host_ips_cached():
+    ips = _resolve_host_ips('localhost')
+    assert isinstance(ips, frozenset)
+    assert 'localhost' in ips
+    assert _resolve_host_ips('localhost') is ips
+
+
+@pytest.mark.parametrize('host', ('::1', '127.0.0.2', '::ffff:127.0.0.2'))
+def test_loopback_allowed(host):
+    wrapped = _wrap_connect()
+    assert wrapped((host, 80)) == ((host, 80), (), {})
+
+    with pytest.raises(OSError):
+        wrapped(('127.evil.example', 80))
+
+
+@pytest.mark.parametrize('host', ('data.astropy.org', 'foo.data.astropy.org'))
+def test_allowed_names_skip_resolution(host):
+    wrapped = _wrap_connect(allowed_names=frozenset({'data.astropy.org'}))
+    assert wrapped((host, 80)) == ((host, 80), (), {})
+
+    with pytest.raises(OSError):
+        wrapped(('notdata.astropy.org', 80))
+
+
+def test_check_internet_off():
+    wrapped = disable_internet.check_internet_off(_connect)
+    assert wrapped(('127.0.0.1', 80)) == (('127.0.0.1', 80), (), {})
+
+    with pytest.raises(OSError):
+        wrapped(('192.0.2.1', 80))
+
+
+def test_resolve_ip_literal(monkeypatch):
+    def getaddrinfo(*args, **kwargs):
+        raise AssertionError('getaddrinfo should not be called')
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    _resolve_host_ips.cache_clear()
+    assert _resolve_host_ips('192.0.2.1') == {'192.0.2.1'}
+    assert _resolve_host_ips('2001:db8::1') == {'2001:db8::1'}
+    assert _resolve_host_ips('2001:DB8:0:0::1') == {'2001:DB8:0:0::1',
+                                                    '2001:db8::1'}
+
+
+@pytest.fixture
+def internet_on(monkeypatch):
+    """
+    Start from internet access being enabled, whatever the plugin did for this
+    session, and put the plugin's state back afterwards.
+    """
+
+    monkeypatch.setattr(disable_internet, '_DEPTH', 0)
+    monkeypatch.setattr(disable_internet, 'INTERNET_OFF', False)
+    monkeypatch.setattr(urllib.request, '_opener', urllib.request._opener)
+    monkeypatch.setattr(socket, 'create_connection',
+                        disable_internet.socket_create_connection)
+    monkeypatch.setattr(socket.socket, 'bind', disable_internet.socket_bind)
+    monkeypatch.setattr(socket.socket, 'connect',
+                        disable_internet.socket_connect)
+
+
+def test_nested_turn_off_internet(internet_on):
+    disable_internet.turn_off_internet()
+    disabled_connect = socket.socket.connect
+    assert disabled_connect is not disable_internet.socket_connect
+
+    disable_internet.turn_off_internet()
+    assert disable_internet._DEPTH == 2
+
+    # Only the outermost call should restore the original functions
+    disable_internet.turn_on_internet()
+    assert disable_internet.INTERNET_OFF
+    assert socket.socket.connect is disabled_connect
+
+    disable_internet.turn_on_internet()
+    assert not disable_internet.INTERNET_OFF
+    assert socket.socket.connect is disable_internet.socket_connect
+
+    # Extra calls are harmless
+    disable_internet.turn_on_internet()
+    assert disable_internet._DEPTH == 0
+
+
+def test_concurrent_turn_off_internet(internet_on, monkeypatch):
+    n_threads = 8
+    barrier = threading.Barrier(n_threads)
+    install_opener = urllib.request.install_opener
+    still_on = []
+
+    def slow_install_opener(opener):
+        # Give other threads a chance to run while internet access is being
+        # turned off or on
+        time.sleep(0.001)
+        install_opener(opener)
+
+    monkeypatch.setattr(urllib.request, 'install_opener', slow_install_opener)
+
+    def toggle():
+        barrier.wait()
+        for _ in range(20):
+            disable_internet.turn_off_internet()
+            time.sleep(0.001)
+            if socket.socket.connect is disable_internet.socket_connect:
+                still_on.append(True)
+            disable_internet.turn_on_internet()
+
+    threads = [Thread(target=toggle) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not still_on
+    assert disable_internet._DEPTH == 0
+    assert not disable_internet.INTERNET_OFF
+    assert socket.create_connection is disable_internet.socket_create_connection
+    assert socket.socket.bind is disable_internet.socket_bind
+    assert socket.socket.connect is disable_internet.socket_connect
+
+
+def test_no_prefetch_without_allowed_hosts(internet_on):
+    assert disable_internet._prefetch_valid_hosts(
+        False, False) is disable_internet._LOCAL_HOSTS
+
+    disable_internet.turn_off_internet()
+    try:
+        assert not any(thread.name == 'remotedata-prefetch'
+                       for thread in threading.enumerate())
+    finally:
+        disable_internet.turn_on_internet()
+
+
+def test_local_names_rewritten_to_localhost():
+    wrapped = _wrap_connect(local_names=frozenset({'myhost'}))
+    assert wrapped(('myhost', 80), 5, source_address=None) == (
+        ('localhost', 80), (5,), {'source_address': None})
+
+
+def test_host_check_parses_ip_literals_once(monkeypatch):
+    def resolve_host_ips(*args, **kwargs):
+        raise AssertionError('IP literals should not be resolved')
+
+    monkeypatch.setattr(disable_internet, '_resolve_host_ips',
+                        resolve_host_ips)
+    check_host = _make_host_check(frozenset({'2001:db8::1'}), frozenset(),
+                                  frozenset())
+    assert check_host('2001:DB8:0:0::1') == '2001:DB8:0:0::1'
+    with pytest.raises(OSError):
+        check_host('192.0.2.1')
+
+
+def test_host_check_waits_for_prefetched_hosts():
+    valid_hosts = Future()
+    check_host = _make_host_check(valid_hosts, frozenset(), frozenset())
+
+    # Loopback addresses are allowed before the prefetch has finished
+    assert check_host('127.0.0.1') == '127.0.0.1'
+
+    valid_hosts.set_result(frozenset({'192.0.2.1'}))
+    assert check_host('192.0.2.1') == '192.0.2.1'
+    with pytest.raises(OSError):
+        check_host('192.0.2.2')
+
+
+def test_resolve_failure_cached(monkeypatch):
+    calls = []
+
+    def getaddrinfo(*args, **kwargs):
+        calls.append(args)
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    _resolve_host_ips.cache_clear()
+    assert _resolve_host_ips('offline.example') == {'offline.example'}
+    assert _resolve_host_ips('offline.example') == {'offline.example'}
+    assert len(calls) == 1
+
+
+def test_allowed_hosts_resolved_concurrently(monkeypatch):
+    n_hosts = len(disable_internet.ASTROPY_HOSTS)
+    barrier = threading.Barrier(n_hosts, timeout=5)
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        # Only returns once every host is being looked up at the same time
+        barrier.wait()
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', port))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    _resolve_host_ips.cache_clear()
+    ips = disable_internet._resolve_allowed_hosts(allow_astropy_data=True)
+    assert '192.0.2.1' in ips
+    _resolve_host_ips.cache_clear()